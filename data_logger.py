@@ -21,9 +21,16 @@
 import os
 import ccs_base
 import argparse
+import atexit
+import gc
+import heapq
 import logging
+import logging.handlers
+import queue
+import signal
 import time
 from importlib import import_module
+from operator import itemgetter
 import datetime as dt
 
 from ccs_dlconfig import config
@@ -43,10 +50,27 @@ MANIFESTS_DIR                       = 'manifests'
 # a one day default file rollover...
 DEFAULT_COLLECT_PERIOD              = 30
 DEFAULT_ROLLOVER_COUNT              = 48
+# Write every row to the card as soon as it is collected unless the settings ask
+# to hold more rows in memory...
+DEFAULT_FLUSH_COUNT                 = 1
+# ...and never hold a row longer than this, however high the flush count is, so
+# a slow sensor with a large flush count doesn't sit on hours of data. The main
+# loop wakes up between collections to enforce it, so for periods of this length
+# or longer every row is written before the next one is collected.
+MAX_PENDING_SECONDS                 = 15 * 60
 COLLECT_SUFFIX                      = '_ccs_data_logger.csv'
+COLLECT_BUFFER_SIZE                 = 64 * 1024
+ROW_BUFFER_SOFT_MAX                 = 128 * 1024
+ROW_DATE_FORMAT                     = '%Y%m%d '
+# Collection periods are configured in minutes
+TICK_SECONDS                        = 60
+VALUE_GETTER                        = itemgetter(1)
 LOG_SUFFIX                          = '_ccs_data_logger.log'
+LOG_TIME_FORMAT                     = '%Y-%m-%d %H:%M:%S'
+LOG_RECORD_FORMAT                   = '%(asctime)s [%(tag)s] %(message)s'
 
 TAG_ACTIVE            = 'active'
+TAG_FLUSH_COUNT       = 'flush-count'
 TAG_PERIOD            = 'period'
 TAG_MANAGER           = 'manager'
 TAG_MODULE_CONFIG     = 'module-config'
@@ -69,28 +93,91 @@ TOO_MANY_INFO_MSGS     = 'Too many non-error messages to report...'
 g_done = False
 g_collect = True
 g_config = None
-g_info_count = 0
-g_error_count = 0
+
+# Formats a UTC struct_time as the given date format followed by HH:MM:SS.
+# strftime() only runs when the day changes, the time of day is formatted
+# from the integer fields.
+class TimestampFormatter(object):
+
+    def __init__(self,date_format):
+        self.date_format = date_format
+        self.day = None
+        self.date_str = ''
+
+    def format(self,tm):
+        day = (tm.tm_year,tm.tm_yday)
+        if day != self.day:
+            self.day = day
+            self.date_str = time.strftime(self.date_format,tm)
+        return f'{self.date_str}{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}'
+
+# Objects created by each module's load(), keyed by module name. They are kept
+# across run() calls so a restart only re-configures them...
+g_module_objects = dict()
+
+g_row_time = TimestampFormatter(ROW_DATE_FORMAT)
+
+# Everything logmsg() needs, gathered in one place so each call is a few
+# attribute reads instead of global and hasattr() checks. Messages go through
+# a queue to a listener thread that does the file I/O, so neither the main
+# loop nor a sensor module calling back into logmsg() waits on the disk.
+class LogState(object):
+    __slots__ = ('path','logger','queue_handler','listener','info_count','error_count')
+
+    def __init__(self):
+        self.path = None
+        self.logger = logging.getLogger(NAME)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.queue_handler = None
+        self.listener = None
+        self.info_count = 0
+        self.error_count = 0
+
+    def open(self,path):
+        self.close()
+        self.path = path
+        formatter = logging.Formatter(LOG_RECORD_FORMAT,LOG_TIME_FORMAT)
+        formatter.converter = time.gmtime
+        file_handler = logging.FileHandler(path,encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(log_queue)
+        self.logger.addHandler(self.queue_handler)
+        self.listener = logging.handlers.QueueListener(log_queue,file_handler)
+        self.listener.start()
+
+    # Stopping the listener writes out anything still queued
+    def close(self):
+        if self.listener is not None:
+            self.logger.removeHandler(self.queue_handler)
+            self.queue_handler = None
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
+g_log = LogState()
 
 # level is 0 for information, anything else is error
 def logmsg(tag,msg,level=0):
-    global g_config
-    global g_info_count
-    global g_error_count
-    if hasattr(g_config,'log_path') and None is not g_config.log_path:
-        if (level == 0 and g_info_count <= MAX_REPORTED_INFO_MSGS) or (g_error_count <= MAX_REPORTED_ERRORS):
-            with open(g_config.log_path,'a') as fd:
-                ts = dt.datetime.now(dt.UTC)
-                s = ts.strftime('%Y-%m-%d %H:%M:%S ') + '[' + tag + '] ' + msg + '\n'
-                fd.write(s)
-                if level != 0 and (g_error_count == MAX_REPORTED_ERRORS):
-                    fd.write(TOO_MANY_ERRORS)
-                if level == 0 and (g_info_count == MAX_REPORTED_INFO_MSGS):
-                    fd.write(TOO_MANY_INFO_MSGS)
-            if level == 0:
-                g_info_count += 1
-            else:
-                g_error_count += 1
+    log = g_log
+    if log.listener is None:
+        return
+    # Once a level has used up its quota, return before doing any work
+    if level == 0:
+        if log.info_count >= MAX_REPORTED_INFO_MSGS:
+            return
+        log.info_count += 1
+        last = (log.info_count == MAX_REPORTED_INFO_MSGS)
+    else:
+        if log.error_count >= MAX_REPORTED_ERRORS:
+            return
+        log.error_count += 1
+        last = (log.error_count == MAX_REPORTED_ERRORS)
+    if last:
+        msg += '\n' + (TOO_MANY_INFO_MSGS if level == 0 else TOO_MANY_ERRORS)
+    log.logger.log(logging.INFO if level == 0 else logging.ERROR,msg,extra={'tag':tag})
 
 class CollectionEvent(object):
 
@@ -98,26 +185,110 @@ class CollectionEvent(object):
         self.sensors = list()
         self.settings = list()
         self.path = None
-        self.ticks = 0
+        self.fd = None
+        self.row_buf = bytearray()
+        self.row_len = 0
+        self.flush_count = DEFAULT_FLUSH_COUNT
+        self.pending_rows = 0
+        self.pending_since = None
+        self.header = None
+        self.row_format = None
+        self.column_counts = ()
+        self.mismatch_logged = False
         self.header_written = False
         self.start_time = None
         self.run_time = None
 
-    def __str__(self):
-        rv = ''
-        for s in self.sensors:
-            rv += 'name: ' + s.get_label()
-            rv += ', '
+    # True if the open file was deleted out from under the logger. This checks
+    # the open handle, so it costs no path lookup and still notices if a new
+    # file has since been created under the same name.
+    def file_removed(self):
+        return self.fd is not None and os.fstat(self.fd).st_nlink == 0
+
+    def open(self):
+        # Rows carried over from a deleted file stay pending for this one
+        if self.fd is not None:
+            self.close()
+        self.fd = os.open(self.path,os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,0o666)
+
+    # Encoded rows wait in row_buf until the event is flushed; row_len is how
+    # much of it is in use. The buffer is overwritten rather than cleared, since
+    # clearing a bytearray gives its memory back.
+    def append(self,data):
+        end = self.row_len + len(data)
+        buf = self.row_buf
+        if len(buf) < end:
+            buf += bytes(end - len(buf))
+        buf[self.row_len:end] = data
+        self.row_len = end
+        if end >= COLLECT_BUFFER_SIZE:
+            self.write_rows()
+
+    # Writes the pending bytes straight to the file descriptor, with no Python
+    # level file buffer in between
+    def write_rows(self):
+        if self.fd is not None and self.row_len > 0:
+            with memoryview(self.row_buf) as view:
+                data = view[:self.row_len]
+                while len(data) > 0:
+                    data = data[os.write(self.fd,data):]
+                data.release()
+        self.row_len = 0
+        # Don't hold on to the memory of an unusually large batch of rows
+        if len(self.row_buf) > ROW_BUFFER_SOFT_MAX:
+            self.row_buf = bytearray()
+
+    def flush(self):
+        self.write_rows()
+        self.pending_rows = 0
+        self.pending_since = None
+
+    # Called when the file was deleted while rows were still waiting. The
+    # descriptor is closed without writing to it, so the rows go to the next
+    # file instead, behind the header if the deleted file already had it.
+    def drop_file(self):
+        if os.fstat(self.fd).st_size > 0:
+            self.row_buf = bytearray(self.header) + self.row_buf[:self.row_len]
+            self.row_len = len(self.row_buf)
+        os.close(self.fd)
+        self.fd = None
+
+    def close(self):
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # Lines a read up with the file's columns for the row format: each sensor's
+    # values are cut or padded with empty fields to its column count, and an
+    # entry that isn't a (name,value) pair becomes an empty field
+    def fit_values(self,reads):
+        rv = []
+        for values,count in zip(reads,self.column_counts):
+            fitted = [x[1] if len(x) == 2 else '' for x in values[:count]]
+            fitted.extend([''] * (count - len(fitted)))
+            rv.extend(fitted)
         return rv
 
+    def __str__(self):
+        return ''.join('name: ' + s.get_label() + ', ' for s in self.sensors)
+
 class PowerModuleSettings(object):
 
     def __init__(self):
         self.name = None
         self.active = False
         self.period = 0
+        self.config_node = None
         self.config = None
 
+    # Modules are configured with the serialized XML, so only build it
+    # for settings whose module is actually loaded
+    def get_config(self):
+        if self.config is None and self.config_node is not None:
+            self.config = et.tostring(self.config_node,encoding='unicode')
+        return self.config
+
 class SensorSettings(object):
 
     def __init__(self):
@@ -126,259 +297,361 @@ class SensorSettings(object):
         self.period = 0
         self.rollover_max = 0
         self.rollover_count = 0
+        self.flush_count = DEFAULT_FLUSH_COUNT
+        self.config_node = None
         self.config = None
 
+    def get_config(self):
+        if self.config is None and self.config_node is not None:
+            self.config = et.tostring(self.config_node,encoding='unicode')
+        return self.config
+
     def __repr__(self):
-        rv = ''
-        rv += 'name: ' + str(self.name) + ', active: ' + str(self.active) + ', period: ' + str(self.period) + ', rollover_max: ' + str(self.rollover_max)
-        return rv
+        return f'name: {self.name}, active: {self.active}, period: {self.period}, rollover_max: {self.rollover_max}'
 
 class LoggerSettings(config.Settings):
 
     def __init__(self):
         super().__init__()
         self.sensor_settings = list()
+        self.sensor_settings_by_name = dict()
         self.power_settings = list()
+        self.power_settings_by_name = dict()
         self.log_path = None
+        self.mtime = None
         self.power_manager = None
         self.schedule = None
 
     def read(self,path):
+        self.mtime = os.stat(path).st_mtime
         super().read(path)
-        if None is not self.log_dir:
+        if self.log_dir is not None:
             ts = dt.datetime.now(dt.UTC)
             name = ts.strftime('%Y%m%d%H%M%S') + LOG_SUFFIX
             self.log_path = os.path.join(g_config.log_dir,name)
         else:
             self.log_path = '/tmp/data_logger.log'
+        g_log.open(self.log_path)
 
         sensors = self.root.find(TAG_SENSORS)
-        if None is not sensors:
+        if sensors is not None:
+            # Local names for the tags and builtins used in the loops below
+            name_tag = TAG_NAME
+            schedule_tag = TAG_SCHEDULE
+            config_tag = TAG_SENSOR_CONFIG
+            period_tag = TAG_PERIOD
+            rollover_tag = TAG_ROLLOVER_COUNT
+            flush_tag = TAG_FLUSH_COUNT
+            _int = int
+            _strip = str.strip
+
+            # Each element's children are visited once and dispatched on their
+            # tag, rather than scanned again by a find() per expected tag
             for sensor_node in sensors:
                 new_sensor_settings = SensorSettings() 
-                name_node = sensor_node.find(TAG_NAME)
-                if None is not name_node:
-                    new_sensor_settings.name = name_node.text.strip()
-                schedule = sensor_node.find(TAG_SCHEDULE)
-                period_node = schedule.find(TAG_PERIOD)
-                new_sensor_settings.period = int(period_node.text.strip())
-                rcount = schedule.find(TAG_ROLLOVER_COUNT)
-                if None is not rcount:
-                    new_sensor_settings.rollover_max = int(rcount.text.strip())
-                config_node = sensor_node.find(TAG_SENSOR_CONFIG)
-                if None is not config_node:
-                    new_sensor_settings.config = et.tostring(config_node).decode('utf-8') 
+                schedule = ()
+                for child in sensor_node:
+                    tag = child.tag
+                    if tag == name_tag:
+                        new_sensor_settings.name = _strip(child.text)
+                    elif tag == schedule_tag:
+                        schedule = child
+                    elif tag == config_tag:
+                        new_sensor_settings.config_node = child
+                period = None
+                for child in schedule:
+                    tag = child.tag
+                    if tag == period_tag:
+                        period = _int(_strip(child.text))
+                    elif tag == rollover_tag:
+                        new_sensor_settings.rollover_max = _int(_strip(child.text))
+                    elif tag == flush_tag:
+                        new_sensor_settings.flush_count = max(1,_int(_strip(child.text)))
+                if period is None:
+                    logmsg(NAME,'Sensor has no schedule period, not collecting it: ' + str(new_sensor_settings.name),ERROR_MSG)
+                    continue
+                new_sensor_settings.period = period
                 self.sensor_settings.append(new_sensor_settings)
+                self.sensor_settings_by_name.setdefault(new_sensor_settings.name,new_sensor_settings)
         else:
             logmsg(NAME,"No sensor module configuration found",ERROR_MSG)
 
         power_modules = self.root.find(TAG_POWER_MODULES)
-        if None is not power_modules:
+        if power_modules is not None:
+            active_tag = TAG_ACTIVE
+            period_tag = TAG_PERIOD
+            config_tag = TAG_MODULE_CONFIG
+            _int = int
+            _strip = str.strip
+
             for mod_node in power_modules:
                 new_settings = PowerModuleSettings()
                 new_settings.name = mod_node.get('name')
-                active_node = mod_node.find(TAG_ACTIVE)
-                if None is not active_node:
-                    new_settings.active = interpret_boolean_value(active_node.text.strip())
-                period_node = mod_node.find(TAG_PERIOD)
-                if None is not period_node:
-                    new_settings.period = int(period_node.text.strip())
-                config_node = mod_node.find(TAG_MODULE_CONFIG)
-                if None is not config_node:
-                    new_settings.config = et.tostring(config_node).decode('utf-8') 
+                for child in mod_node:
+                    tag = child.tag
+                    if tag == active_tag:
+                        new_settings.active = interpret_boolean_value(_strip(child.text))
+                    elif tag == period_tag:
+                        new_settings.period = _int(_strip(child.text))
+                    elif tag == config_tag:
+                        new_settings.config_node = child
                 self.power_settings.append(new_settings)
+                self.power_settings_by_name.setdefault(new_settings.name,new_settings)
         else:
             logmsg(NAME,"No power module configuration found",INFO_MSG)
 
 
+# Returns the names of the modules in a module directory, creating it if needed
+def find_module_names(path):
+    if not os.path.exists(path):
+        os.mkdir(path,mode=0o755)
+    # Modules may be links to the real files, which is_file() follows
+    with os.scandir(path) as entries:
+        return [e.name[:-3] for e in entries if e.is_file() and e.name.endswith('.py') and e.name != '__init__.py']
+
+def get_module_object(name):
+    rv = g_module_objects.get(name)
+    if rv is None:
+        mod = import_module(name)
+        if hasattr(mod,'load'):
+            rv = mod.load()
+            g_module_objects[name] = rv
+    return rv
+
 class CcsLogger(object):
 
     def __init__(self):
         self.sensors = list()
+        self.sensors_by_label = dict()
         self.load_sensor_modules()
         self.power_modules = list()
         self.load_power_modules()
 
-    def get_sensor_settings(self,name):
-        global g_config
-        rv = None
-        for ss in g_config.sensor_settings:
-            if name == ss.name:
-                rv = ss
-                break
-        return rv
-
-    def get_power_settings(self,name):
-        global g_config
-        rv = None
-        for ss in g_config.power_settings:
-            if name == ss.name:
-                rv = ss
-                break
-        return rv
-
     def get_sensor(self,name):
-        rv = None
-        for s in self.sensors:
-            if s.get_label() == name:
-                rv = s
-                break
-        return rv
+        return self.sensors_by_label.get(name)
 
     def load_sensor_modules(self):
-        if False == os.path.exists(SENSOR_MODULE_DIR):
-            os.mkdir(SENSOR_MODULE_DIR,mode=0o755)
-        files = os.listdir(SENSOR_MODULE_DIR)
-        for f in files:
-            fullpath = os.path.join(SENSOR_MODULE_DIR,f)
-            if os.path.isdir(fullpath):
-                continue
-            if f.endswith('.py'):
-                if '__init__.py' != f:
-                    f = f[:-3]
-                    name = SENSOR_MODULE_DIR + '.' + f
-                    try:
-                        mod = import_module(name)
-                        if hasattr(mod,"load"):
-                            obj = mod.load()
-                            obj.sensor_name = f
-                            if hasattr(obj,'set_log_callback'):
-                                obj.set_log_callback(logmsg)
-                            sensor_settings = self.get_sensor_settings(f)
-                            if None is not sensor_settings:
-                                if hasattr(obj,'set_config'):
-                                    obj.set_config(sensor_settings.config)
-                            self.sensors.append(obj)
-
-                            mf = manifest.Manifest()
-                            mf_path = os.path.join(SENSOR_MODULE_DIR,MANIFESTS_DIR)
-                            if os.path.exists(mf_path):
-                                mf_path = os.path.join(mf_path,f + MANIFEST_SUFFIX)
-                                mf.read(mf_path)
-                            if (None is not mf.commit) and (len(mf.commit) > 0):
-                                logmsg(NAME,'Loaded sensor module: ' + f + ' [commit: ' + str(mf.commit) + ']',INFO_MSG)
-                            else:
-                                logmsg(NAME,'Loaded sensor module: ' + f,INFO_MSG)
-                        else:
-                            logmsg(NAME,'Sensor module has no load function: ' + f,ERROR_MSG)
-                    except Exception as ex:
-                        logmsg(NAME,'Failed to load sensor module ' + f + ': ' + str(ex),ERROR_MSG)
+        global g_config
+        for f in find_module_names(SENSOR_MODULE_DIR):
+            name = SENSOR_MODULE_DIR + '.' + f
+            try:
+                obj = get_module_object(name)
+                if obj is not None:
+                    obj.sensor_name = f
+                    if hasattr(obj,'set_log_callback'):
+                        obj.set_log_callback(logmsg)
+                    sensor_settings = g_config.sensor_settings_by_name.get(f)
+                    if sensor_settings is not None:
+                        if hasattr(obj,'set_config'):
+                            obj.set_config(sensor_settings.get_config())
+                    self.sensors.append(obj)
+                    self.sensors_by_label.setdefault(obj.get_label(),obj)
+
+                    mf = manifest.Manifest()
+                    mf_path = os.path.join(SENSOR_MODULE_DIR,MANIFESTS_DIR)
+                    if os.path.exists(mf_path):
+                        mf_path = os.path.join(mf_path,f + MANIFEST_SUFFIX)
+                        mf.read(mf_path)
+                    if mf.commit:
+                        logmsg(NAME,'Loaded sensor module: ' + f + ' [commit: ' + str(mf.commit) + ']',INFO_MSG)
+                    else:
+                        logmsg(NAME,'Loaded sensor module: ' + f,INFO_MSG)
+                else:
+                    logmsg(NAME,'Sensor module has no load function: ' + f,ERROR_MSG)
+            except Exception as ex:
+                logmsg(NAME,'Failed to load sensor module ' + f + ': ' + str(ex),ERROR_MSG)
 
     def load_power_modules(self):
-        if False == os.path.exists(POWER_MODULE_DIR):
-            os.mkdir(POWER_MODULE_DIR,mode=0o755)
-        files = os.listdir(POWER_MODULE_DIR)
-        for f in files:
-            if f.endswith('.py'):
-                if '__init__.py' != f:
-                    f = f[:-3]
-                    name = POWER_MODULE_DIR + '.' + f
-                    try:
-                        mod = import_module(name)
-                        if hasattr(mod,"load"):
-                            obj = mod.load()
-                            obj.sensor_name = f
-                            if hasattr(obj,'set_log_callback'):
-                                obj.set_log_callback(logmsg)
-                            power_settings = self.get_power_settings(f)
-                            if None is not power_settings:
-                                if hasattr(obj,'set_config'):
-                                    obj.set_config(power_settings.config)
-                            self.power_modules.append(obj)
-                            logmsg(NAME,'Loaded power module: ' + f,INFO_MSG)
-                        else:
-                            logmsg(NAME,'Power module has no load function: ' + f,ERROR_MSG)
-                    except Exception as ex:
-                        logmsg(NAME,'Failed to load power module (' + f + '): ' + str(ex),ERROR_MSG)
-
-    def collect(self,event):
-        timestamp = dt.datetime.now(dt.UTC)
+        global g_config
+        for f in find_module_names(POWER_MODULE_DIR):
+            name = POWER_MODULE_DIR + '.' + f
+            try:
+                obj = get_module_object(name)
+                if obj is not None:
+                    obj.sensor_name = f
+                    if hasattr(obj,'set_log_callback'):
+                        obj.set_log_callback(logmsg)
+                    power_settings = g_config.power_settings_by_name.get(f)
+                    if power_settings is not None:
+                        if hasattr(obj,'set_config'):
+                            obj.set_config(power_settings.get_config())
+                    self.power_modules.append(obj)
+                    logmsg(NAME,'Loaded power module: ' + f,INFO_MSG)
+                else:
+                    logmsg(NAME,'Power module has no load function: ' + f,ERROR_MSG)
+            except Exception as ex:
+                logmsg(NAME,'Failed to load power module (' + f + '): ' + str(ex),ERROR_MSG)
+
+    # timestamp and its row string (ts_str) are computed once per tick by the caller
+    def collect(self,event,timestamp,ts_str):
         event.settings[0].rollover_count += 1
         # Get the runtime in seconds
         event.run_time = event.settings[0].rollover_max * event.settings[0].period * 60
         # 10 years is a ridiculous amount of time to be paused...
         time_diff = dt.timedelta(seconds=3600*24*365*10)
-        if None is not event.start_time:
+        if event.start_time is not None:
             time_diff = timestamp - event.start_time
-        if (event.path == None) or (event.settings[0].rollover_count >= event.settings[0].rollover_max) or (time_diff.seconds > event.run_time) or ((None is not event.path) and (False == os.path.exists(event.path))):
+        removed = event.file_removed()
+        if (event.path is None) or (event.settings[0].rollover_count >= event.settings[0].rollover_max) or (time_diff.seconds > event.run_time) or removed:
             event.start_time = timestamp
-            event.path = self.get_collect_file_path(event)
+            event.path = self.get_collect_file_path(event,timestamp)
             event.settings[0].rollover_count = 0
-
-        s = timestamp.strftime('%Y%m%d %H:%M:%S')
-        event.header_written = True
-        with open(event.path,'a') as fd:
-            data = tuple()
-            if 0 == os.path.getsize(event.path):
+            if removed and event.row_len > 0:
+                # The waiting rows keep their columns, so the header stays too
+                event.drop_file()
+            else:
+                event.header = None
                 event.header_written = False
-            for sensor in event.sensors:
-                data += sensor.get_current_values()
-            if False == event.header_written:
-                header = self.get_header(data)
-                fd.write(header + '\n')
-                event.header_written = True
-            for x in data:
-                if 2 == len(x):
-                    s += ',' + str(x[1])
-            fd.write(s + '\n')
-
-    def get_header(self,dataset):
-        s = ccs_base.CCS_UTC_TIMESTAMP_UUID
-        for x in dataset:
-            s += ',' + str(x[0])
-        return s
-
-    def get_collect_file_path(self,event):
+                event.close()
+
+        # The file stays open until the next rollover...
+        if event.fd is None:
+            event.open()
+
+        reads = []
+        data = tuple()
+        for sensor in event.sensors:
+            values = sensor.get_current_values()
+            reads.append(values)
+            data += values
+        if event.header is None:
+            # The columns are set by the first read of each file. A sensor whose
+            # read is empty or not (name,value) pairs gets no columns in this
+            # file and is picked up again at the next rollover.
+            parts = [ccs_base.CCS_UTC_TIMESTAMP_UUID]
+            counts = []
+            for sensor,values in zip(event.sensors,reads):
+                if values and all(len(x) == 2 for x in values):
+                    parts.extend(str(x[0]) for x in values)
+                    counts.append(len(values))
+                else:
+                    logmsg(NAME,'Sensor values are not (name,value) pairs, leaving it out of this file: ' + sensor.get_label(),ERROR_MSG)
+                    counts.append(0)
+            event.header = (','.join(parts) + '\n').encode('utf-8')
+            event.column_counts = tuple(counts)
+            # ...and so is the row layout, so build one format for the whole row
+            event.row_format = '%s' + ',%s' * sum(counts) + '\n'
+        if not event.header_written:
+            event.append(event.header)
+            event.header_written = True
+        # One % operation formats the timestamp and every value. Rows are
+        # encoded here and kept as bytes, skipping the text layer. The pairs
+        # aren't checked on every read: a read that doesn't match the columns
+        # fails the count check or the format, and only then is looked at.
+        row = None
+        if tuple(map(len,reads)) == event.column_counts:
+            try:
+                row = event.row_format % (ts_str,*map(VALUE_GETTER,data))
+            except (IndexError,TypeError):
+                pass
+        if row is None:
+            # A sensor that keeps doing this would otherwise use up the error
+            # quota, so it's reported once per event
+            if not event.mismatch_logged:
+                logmsg(NAME,'Sensor values don\'t match the columns of ' + str(event.path) + ', later mismatches are not reported',ERROR_MSG)
+                event.mismatch_logged = True
+            row = event.row_format % (ts_str,*event.fit_values(reads))
+        event.append(row.encode('utf-8'))
+        if event.pending_rows == 0:
+            event.pending_since = time.monotonic()
+        event.pending_rows += 1
+
+    # The YYYYMMDD_HHMMSS part of the name is formatted from the tick's time
+    # fields, as the row timestamp is, without going through strftime()
+    def get_collect_file_path(self,event,timestamp):
         global g_config
-        ts = dt.datetime.now(dt.UTC)
         period = '_p' + str(event.settings[0].period) + '_r' + str(event.settings[0].rollover_max)
-        name = ts.strftime('%Y%m%d_%H%M%S') + period + COLLECT_SUFFIX
-        return os.path.join(g_config.csv_dir,name)
+        t = timestamp
+        base = f'{t.year:04d}{t.month:02d}{t.day:02d}_{t.hour:02d}{t.minute:02d}{t.second:02d}' + period
+        rv = os.path.join(g_config.csv_dir,base + COLLECT_SUFFIX)
+        # A second rollover within the same second would append to the file
+        # that was just finished, so number any later ones
+        seq = 1
+        while os.path.exists(rv):
+            rv = os.path.join(g_config.csv_dir,base + '_' + str(seq) + COLLECT_SUFFIX)
+            seq += 1
+        return rv
 
 # Call this after reading configuration _and_ after loading sensors
 def create_schedule(config,logger):
-    schedule = list()
+    # Sensors that share a period and rollover count are collected together
+    # into one file, so group their settings by that pair
+    events = dict()
     for ss in config.sensor_settings:
-        event = CollectionEvent()
+        key = (ss.period,ss.rollover_max)
+        event = events.get(key)
+        if event is None:
+            event = CollectionEvent()
+            events[key] = event
         event.settings.append(ss)
         s = logger.get_sensor(ss.name)
-        if None is not s:
+        if s is not None:
             event.sensors.append(s)
-        schedule.append(event)
-
-    if len(schedule) > 1:
-        config.schedule = list()
-        for idx in range(len(schedule)):
-            test_event = schedule[idx]
-            if test_event.ticks == 0:
-                test_event.ticks = 1
-                config.schedule.append(test_event)
-                for event in schedule:
-                    if (test_event != event) and (event.ticks == 0):
-                        if (test_event.settings[0].period == event.settings[0].period) and (test_event.settings[0].rollover_max == event.settings[0].rollover_max):
-                            event.ticks = 1
-                            test_event.sensors.append(event.sensors[0])
-                            test_event.settings.append(event.settings[0])
-        for event in config.schedule:
-            event.ticks = 0
-    else:
-        config.schedule = schedule
+        else:
+            logmsg(NAME,'No sensor module loaded for ' + str(ss.name) + ', not collecting it',ERROR_MSG)
+    # A group whose sensors all failed to load would only write timestamps
+    config.schedule = [event for event in events.values() if event.sensors]
+    # Sensors sharing a file share its writes, so the lowest flush-count applies
+    for event in config.schedule:
+        event.flush_count = min(ss.flush_count for ss in event.settings)
+
+# Rows are buffered by collect(), so at the end of a tick write out every
+# event that has collected its flush-count rows or has held a row for
+# MAX_PENDING_SECONDS. The file buffer writes itself out if it fills first,
+# and rollover writes out the rest.
+def flush_collect_files():
+    global g_config
+    if hasattr(g_config,'schedule') and g_config.schedule is not None:
+        now = time.monotonic()
+        for event in g_config.schedule:
+            if event.pending_rows >= event.flush_count:
+                event.flush()
+            elif event.pending_rows > 0 and now - event.pending_since >= MAX_PENDING_SECONDS:
+                event.flush()
+
+# The monotonic time at which the oldest buffered row reaches MAX_PENDING_SECONDS,
+# or None if no rows are waiting
+def get_flush_due():
+    global g_config
+    rv = None
+    if hasattr(g_config,'schedule') and g_config.schedule is not None:
+        for event in g_config.schedule:
+            if event.pending_rows > 0:
+                due = event.pending_since + MAX_PENDING_SECONDS
+                if rv is None or due < rv:
+                    rv = due
+    return rv
+
+def close_collect_files():
+    global g_config
+    if hasattr(g_config,'schedule') and g_config.schedule is not None:
+        for event in g_config.schedule:
+            event.close()
+
+# Turn SIGTERM (systemctl stop) into a normal exit so atexit handlers run
+def handle_terminate(signum,frame):
+    raise SystemExit(0)
 
 def get_schedule(s,banner):
-    rv = str(banner) + '\n'
-    for e in s:
-        rv += str(e) + '\n'
-    return rv
+    lines = [str(banner)]
+    lines.extend(str(e) for e in s)
+    lines.append('')
+    return '\n'.join(lines)
 
 def run(args):
     global g_done
     global g_config
 
     power_manager = None
-    g_config = LoggerSettings()
-    g_config.read(args.config)
-
-#    if None is not g_config.power_manager:
+    # Files left open by a previous run() belong to a schedule that is about
+    # to be rebuilt
+    close_collect_files()
+    # Only parse the settings again if the file changed since the last run()
+    if g_config is None or g_config.mtime != os.stat(args.config).st_mtime:
+        g_config = LoggerSettings()
+        g_config.read(args.config)
+
+#    if g_config.power_manager is not None:
 #        if g_config.power_manager == PM_PISUGAR2:
 #            power_manager = get_pisugar2_manager(g_config)
 #        else:
@@ -386,7 +659,7 @@ def run(args):
 #            logmsg(NAME,msg,INFO_MSG)
 #        # If a power manager is configured, but we can't talk to it, the user has probably
 #        # plugged in the Rasbperry Pi and wants to browse data, rather than collect.
-#        if None is power_manager:
+#        if power_manager is None:
 #            logmsg(NAME,'I assume you want to browse data, not collect. Exiting data logger.')
 #            g_done = True
 #            return
@@ -403,32 +676,67 @@ def run(args):
 
     create_schedule(g_config,data_logger)
 
-    if None is not power_manager:
+    # Settings, modules and the schedule live as long as the process, so move
+    # them out of the collector's way before the main loop starts
+    gc.collect()
+    gc.freeze()
+
+    if power_manager is not None:
+       timestamp = dt.datetime.now(dt.UTC)
+       ts_str = g_row_time.format(timestamp.utctimetuple())
        for event in g_config.schedule:
-           data_logger.collect(event)
+           data_logger.collect(event,timestamp,ts_str)
        else:
            logmsg(NAME,"Couldn't find settings for " + sensor_module.sensor_name,ERROR_MSG)
+       flush_collect_files()
        power_manager.sleep(g_config.power_period) 
     else:
-        while True == g_collect:
-            for event in g_config.schedule:
-                if None is not event.settings[0]:
-                    if event.ticks >= event.settings[0].period or False == event.header_written:
-                        data_logger.collect(event)
-                        event.ticks = 0
-                    event.ticks += 1
-                else:
-                    msg = 'Sensor module is missing sensor-config in settings file: ' + sensor_module.get_label()
-                    logmsg(NAME,msg,ERROR_MSG)
-            # 60 seconds per tick
-            time.sleep(60)
-
-
-if '__main__' == __name__:
+        # Every event sits in the heap under the monotonic time it is next due
+        # (the index breaks ties so events are never compared). Deadlines are
+        # advanced from when the event was due, not from when it ran, so the
+        # time spent collecting doesn't make the schedule drift.
+        start = time.monotonic()
+        heap = [(start,idx,event) for idx,event in enumerate(g_config.schedule)]
+        heapq.heapify(heap)
+        while g_collect:
+            if not heap:
+                time.sleep(TICK_SECONDS)
+                continue
+            next_due = heap[0][0]
+            # Rows still in memory when their age limit comes up are written
+            # then, rather than waiting for the next collection
+            flush_due = get_flush_due()
+            if flush_due is not None and flush_due < next_due:
+                time.sleep(max(0,flush_due - time.monotonic()))
+                flush_collect_files()
+                continue
+            time.sleep(max(0,next_due - time.monotonic()))
+            timestamp = dt.datetime.now(dt.UTC)
+            ts_str = g_row_time.format(timestamp.utctimetuple())
+            while heap and heap[0][0] <= next_due:
+                due,idx,event = heapq.heappop(heap)
+                data_logger.collect(event,timestamp,ts_str)
+                period = max(1,event.settings[0].period) * TICK_SECONDS
+                due += period
+                # If the loop fell more than a whole period behind (a stalled write
+                # or a slow sensor), skip the missed collections while staying on
+                # the original cadence, rather than running them back to back
+                behind = time.monotonic() - due
+                if behind >= 0:
+                    due += (behind // period + 1) * period
+                heapq.heappush(heap,(due,idx,event))
+            flush_collect_files()
+
+
+if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-c','--config',required=True,help='Path to config file')
     args = arg_parser.parse_args()
-    while False == g_done:
+    # atexit runs handlers last in first out, so the log is closed last
+    atexit.register(g_log.close)
+    atexit.register(close_collect_files)
+    signal.signal(signal.SIGTERM,handle_terminate)
+    while not g_done:
         run(args)
 
 
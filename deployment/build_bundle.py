@@ -214,31 +214,30 @@ def run(args):
         version = settings.version
 
     # Create the logger manifest
+    current_time = dt.datetime.now(dt.timezone.utc).isoformat(timespec='minutes')
     with open(MANIFEST_NAME,'wt') as fd:
-        fd.write('<?xml version="1.0" encoding="UTF-8"?>' + '\n')
-        fd.write('<manifest>\n')
-        current_time = dt.datetime.now(dt.timezone.utc).isoformat(timespec='minutes')
-        fd.write('<time>' + current_time + '</time>\n')
-        fd.write('<commit>' + commit + '</commit>\n')
-        fd.write('<version>' + str(version) + '</version>\n')
-        fd.write('<name>logger</name>\n')
-        fd.write('</manifest>\n')
+        fd.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<manifest>\n'
+                 f'<time>{current_time}</time>\n'
+                 f'<commit>{commit}</commit>\n'
+                 f'<version>{version}</version>\n'
+                 '<name>logger</name>\n'
+                 '</manifest>\n')
 
     # Create the systemd service file
+    base = settings.paths[TAG_BASE]
     with open(SERVICE_FILE_NAME,'wt') as fd:
-        fd.write('[Unit]\n')
-        fd.write('Description=Clear Creek Scientific Data Logger\n')
-        fd.write('StartLimitIntervalSec=300\n')
-        fd.write('StartLimitBurst=5\n')
-        fd.write('[Service]\n')
-        fd.write('WorkingDirectory=' + settings.paths[TAG_BASE] + '\n')
-        s = 'ExecStart=python ' + settings.paths[TAG_BASE] + '/data_logger.py -c' + settings.paths[TAG_BASE] + '/' + SETTINGS_FILE_NAME + '\n'
-        fd.write(s) 
-        fd.write('Restart=on-failure\n')
-        fd.write('RestartSec=10s\n')
-        fd.write('[Install]\n')
-        fd.write('WantedBy=default.target\n')
- 
+        fd.write('[Unit]\n'
+                 'Description=Clear Creek Scientific Data Logger\n'
+                 'StartLimitIntervalSec=300\n'
+                 'StartLimitBurst=5\n'
+                 '[Service]\n'
+                 f'WorkingDirectory={base}\n'
+                 f'ExecStart=python {base}/data_logger.py -c{base}/{SETTINGS_FILE_NAME}\n'
+                 'Restart=on-failure\n'
+                 'RestartSec=10s\n'
+                 '[Install]\n'
+                 'WantedBy=default.target\n')
 
     # Create the zip file
     zip_name = str(prefix) + '_v' + str(version) + ZIP_SUFFIX